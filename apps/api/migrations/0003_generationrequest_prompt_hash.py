@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-15 21:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_generationrequest_result_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generationrequest',
+            name='prompt_hash',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='generationrequest',
+            index=models.Index(fields=['prompt_hash', 'image_hash'], name='api_generat_prompt__f67151_idx'),
+        ),
+    ]
@@ -14,6 +14,7 @@ class GenerationRequest(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     prompt = models.TextField()
     image_hash = models.CharField(max_length=64, null=True, blank=True)
+    prompt_hash = models.CharField(max_length=64, null=True, blank=True)
     
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='QUEUED')
     reasons = models.JSONField(default=list, blank=True)
@@ -22,5 +23,11 @@ class GenerationRequest(models.Model):
     result_text = models.TextField(null=True, blank=True)
     result_image = models.TextField(null=True, blank=True)  # Base64 encoded image
     
+    class Meta:
+        indexes = [
+            # Lookup for idempotent replays of an identical prompt (+ image)
+            models.Index(fields=['prompt_hash', 'image_hash']),
+        ]
+
     def __str__(self):
         return f"{self.id} - {self.status}"
@@ -1,70 +1,105 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from .models import GenerationRequest
 from .serializers import GenerationRequestSerializer
 from apps.guardrails.engine import GuardrailEngine
 from apps.nano_banana.client import generate_content
 from celery import shared_task
+from datetime import timedelta
+import base64
+import hashlib
 import logging
 
 logger = logging.getLogger(__name__)
 
+if not settings.GUARDRAILS_SHARED_CACHE:
+    logger.warning("Redis unavailable at startup: uploaded images are sent through the broker "
+                   "because workers can't read this process's local cache")
+
+
+def _upload_cache_key(request_id) -> str:
+    """Cache key the uploaded image bytes are staged under until the task picks them up."""
+    return f"upload:{request_id}"
+
+
 @shared_task
-def process_request_task(request_id, prompt, image_bytes_list=None):
+def process_request_task(request_id, prompt, image_hash=None, image_b64=None):
     """
     Async task to process the request.
-    image_bytes_list is a list of integers (bytes) because Celery JSON serialization.
+    Only the image's SHA-256 travels through the broker; the bytes are staged in the cache
+    by GenerateView and read back here exactly once. When that cache isn't shared with the
+    workers, the bytes come base64-encoded in image_b64 instead.
+    The row is claimed (QUEUED -> PROCESSING) and later written with the final outcome,
+    each as a single UPDATE; the row itself is never fetched.
     """
+    rows = GenerationRequest.objects.filter(id=request_id)
+    # Conditional UPDATE as the claim: a duplicate or redelivered task finds the row
+    # no longer QUEUED and exits without re-running the models
+    if not rows.filter(status='QUEUED').update(status='PROCESSING'):
+        logger.info(f"Request {request_id} already claimed, skipping")
+        return
     try:
-        req = GenerationRequest.objects.get(id=request_id)
-        req.status = 'PROCESSING'
-        req.save()
+        image_bytes = None
+        if image_b64:
+            image_bytes = base64.b64decode(image_b64)
+        elif image_hash:
+            cache_key = _upload_cache_key(request_id)
+            image_bytes = cache.get(cache_key)
+            cache.delete(cache_key)
+            if image_bytes is None:
+                raise ValueError("Uploaded image expired before processing")
+
+        engine = GuardrailEngine()
+        result = engine.process_request(prompt, image_bytes, image_hash=image_hash)
         
-        image_bytes = bytes(image_bytes_list) if image_bytes_list else None
+        if result.status != 'PASS':
+            rows.update(status=result.status, reasons=result.reasons, scores=result.scores)
+            return
         
-        engine = GuardrailEngine()
-        result = engine.process_request(prompt, image_bytes)
+        # Call Gemini
+        # If image passed, we need to re-open it or pass bytes. 
+        # The engine returns PIL image in metadata if passed.
+        pil_image = result.metadata.get('pil_image')
+        use_case = result.metadata.get('use_case', 'prompt_analysis')
         
-        req.status = result.status
-        req.reasons = result.reasons
-        req.scores = result.scores
-        req.save()
+        # For use case 1 (image analysis), use the standard prompt for nano_banana
+        # For use case 2 (prompt analysis), use the user's prompt
+        prompt_for_gemini = prompt
+        if use_case == 'image_analysis':
+            # Use the standard prompt for image generation
+            prompt_for_gemini = "generate image with this image attached in center of the background"
+            logger.info("Use Case 1: Using standard prompt for image generation")
+        else:
+            logger.info("Use Case 2: Using user prompt for generation")
         
-        if result.status == 'PASS':
-            # Call Gemini
-            # If image passed, we need to re-open it or pass bytes. 
-            # The engine returns PIL image in metadata if passed.
-            pil_image = result.metadata.get('pil_image')
-            use_case = result.metadata.get('use_case', 'prompt_analysis')
-            
-            # For use case 1 (image analysis), use the standard prompt for nano_banana
-            # For use case 2 (prompt analysis), use the user's prompt
-            prompt_for_gemini = prompt
-            if use_case == 'image_analysis':
-                # Use the standard prompt for image generation
-                prompt_for_gemini = "generate image with this image attached in center of the background"
-                logger.info("Use Case 1: Using standard prompt for image generation")
-            else:
-                logger.info("Use Case 2: Using user prompt for generation")
-            
-            gemini_response = generate_content(prompt_for_gemini, pil_image)
-            # Handle both old string format and new dict format
-            if isinstance(gemini_response, dict):
-                req.result_text = gemini_response.get('text', '')
-                req.result_image = gemini_response.get('image')
-            else:
-                # Backward compatibility with old string format
-                req.result_text = gemini_response
-            req.save()
+        gemini_response = generate_content(prompt_for_gemini, pil_image)
+        # Handle both old string format and new dict format
+        if isinstance(gemini_response, dict):
+            result_text = gemini_response.get('text', '')
+            result_image = gemini_response.get('image')
+        else:
+            # Backward compatibility with old string format
+            result_text = gemini_response
+            result_image = None
+        
+        # PASS is recorded together with the Gemini output so pollers never see PASS without it
+        rows.update(
+            status='PASS',
+            reasons=result.reasons,
+            scores=result.scores,
+            result_text=result_text,
+            result_image=result_image
+        )
             
     except Exception as e:
         logger.error(f"Task failed: {e}")
-        req = GenerationRequest.objects.get(id=request_id)
-        req.status = 'ERROR'
-        req.reasons = [str(e)]
-        req.save()
+        rows.update(status='ERROR', reasons=[str(e)])
 
 class GenerateView(APIView):
     def post(self, request):
@@ -73,37 +108,71 @@ class GenerateView(APIView):
         
         if not prompt:
             return Response({"error": "Prompt is required"}, status=status.HTTP_400_BAD_REQUEST)
-            
-        # Create DB entry
-        req = GenerationRequest.objects.create(prompt=prompt)
-        
-        # Read image bytes if present
+
+        # Validate before touching the DB so rejected uploads cost no writes
+        if len(prompt) > settings.GUARDRAILS_MAX_PROMPT_CHARS:
+            return Response(
+                {"error": f"Prompt exceeds {settings.GUARDRAILS_MAX_PROMPT_CHARS} characters"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        # UploadedFile.size is known without reading the body
+        if image_file and image_file.size > settings.GUARDRAILS_MAX_IMAGE_BYTES:
+            return Response({"error": "Image too large"}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        # Hash the upload while reading it so the bytes are only walked once
         image_bytes = None
+        image_hash = None
         if image_file:
-            image_bytes = image_file.read()
-            # Basic size check before queuing
-            if len(image_bytes) > 5 * 1024 * 1024:
-                 req.status = 'BLOCK'
-                 req.reasons = ["Image too large (pre-check)"]
-                 req.save()
-                 return Response(GenerationRequestSerializer(req).data)
+            digest = hashlib.sha256()
+            chunks = []
+            for chunk in image_file.chunks():
+                digest.update(chunk)
+                chunks.append(chunk)
+            image_bytes = b"".join(chunks)
+            image_hash = digest.hexdigest()
+            
+        # Idempotent replay: an identical prompt (+ image) that passed recently returns that
+        # request instead of re-running the models and Gemini. Gemini failures are not replayed,
+        # and older results are not either, so guardrail or model changes apply to them.
+        prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()
+        previous = (
+            GenerationRequest.objects
+            .filter(
+                prompt_hash=prompt_hash,
+                image_hash=image_hash,
+                status='PASS',
+                created_at__gte=timezone.now() - timedelta(seconds=settings.GUARDRAILS_REPLAY_TTL),
+            )
+            .exclude(result_text__startswith='Gemini Error:')
+            .exclude(result_text__startswith='Error:')
+            .order_by('-created_at')
+            .first()
+        )
+        if previous:
+            return Response(GenerationRequestSerializer(previous).data)
 
-        # Convert bytes to list for JSON serialization if needed, or handle better
-        # For simplicity in this demo, passing small images via Celery args is okay-ish, 
-        # but for prod, save to disk/S3 and pass path.
-        # Given "single VPS" requirement, let's save to tmp and pass path? 
-        # Or just pass bytes if < 5MB. 5MB is small enough for Redis/Celery usually.
-        
-        image_bytes_list = list(image_bytes) if image_bytes else None
-        
-        # Queue task - use apply() in eager mode to execute synchronously without broker
-        from django.conf import settings
-        if getattr(settings, 'CELERY_TASK_ALWAYS_EAGER', False):
-            # In eager mode, use apply() to execute synchronously and avoid broker connection
-            process_request_task.apply(args=[req.id, prompt, image_bytes_list])
-        else:
-            # Normal async execution
-            process_request_task.delay(req.id, prompt, image_bytes_list)
+        # Create DB entry
+        req = GenerationRequest.objects.create(prompt=prompt, prompt_hash=prompt_hash, image_hash=image_hash)
+
+        # Stage the image in the cache and send only its hash through the broker, unless the
+        # cache is local to this process (Redis was down at startup)
+        image_b64 = None
+        if image_bytes:
+            if settings.GUARDRAILS_SHARED_CACHE:
+                cache.set(_upload_cache_key(req.id), image_bytes, settings.GUARDRAILS_UPLOAD_TTL)
+            else:
+                image_b64 = base64.b64encode(image_bytes).decode('ascii')
+
+        # Queue only once the row is committed so the worker never sees a missing row.
+        def queue_task():
+            if getattr(settings, 'CELERY_TASK_ALWAYS_EAGER', False):
+                # In eager mode, use apply() to execute synchronously and avoid broker connection
+                process_request_task.apply(args=[str(req.id), prompt, image_hash, image_b64])
+            else:
+                # Normal async execution
+                process_request_task.delay(str(req.id), prompt, image_hash, image_b64)
+
+        transaction.on_commit(queue_task)
         
         return Response(GenerationRequestSerializer(req).data)
 
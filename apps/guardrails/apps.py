@@ -0,0 +1,14 @@
+import threading
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class GuardrailsConfig(AppConfig):
+    name = 'apps.guardrails'
+
+    def ready(self):
+        if settings.GUARDRAILS_PRELOAD_TEXT_MODEL:
+            # Load in the background so start-up isn't blocked; the first check waits on the
+            # model lock only if it arrives before the load finishes
+            from .text_food_domain import preload_text_model
+            threading.Thread(target=preload_text_model, name="guardrail-preload", daemon=True).start()
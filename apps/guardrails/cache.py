@@ -1,11 +1,20 @@
 import hashlib
+import logging
+import time
+import uuid
 from django.core.cache import cache
 from .schemas import GuardrailResult
 
-def compute_hash(prompt: str, image_hash: str = None) -> str:
-    """Compute a unique hash for the request."""
-    data = f"{prompt}|{image_hash or ''}"
-    return hashlib.sha256(data.encode()).hexdigest()
+logger = logging.getLogger(__name__)
+
+def compute_hash(prompt: str, image_digest: bytes = None) -> str:
+    """Compute a unique hash for the request from the prompt and the image's raw SHA-256 digest."""
+    h = hashlib.blake2b(digest_size=32)
+    h.update(prompt.encode())
+    h.update(b"|")
+    if image_digest:
+        h.update(image_digest)
+    return h.hexdigest()
 
 def get_cached_decision(request_hash: str) -> GuardrailResult:
     """Retrieve cached decision if available."""
@@ -24,3 +33,35 @@ def cache_decision(request_hash: str, result: GuardrailResult, timeout: int = 36
         "metadata": result.metadata
     }
     cache.set(f"guardrail:{request_hash}", data, timeout)
+
+def get_or_compute(request_hash: str, compute_fn, lock_timeout: int = 30) -> GuardrailResult:
+    """
+    Return the cached decision, or compute it once across concurrent identical requests.
+    The first caller takes a short-lived lock and runs compute_fn (which caches its own result);
+    the others poll the cache with exponential backoff until the result lands.
+    """
+    cached = get_cached_decision(request_hash)
+    if cached:
+        logger.info(f"Cache hit for {request_hash}")
+        return cached
+
+    lock_key = f"guardrail-lock:{request_hash}"
+    if cache.add(lock_key, uuid.uuid4().hex, lock_timeout):
+        try:
+            return compute_fn()
+        finally:
+            cache.delete(lock_key)
+
+    delay = 0.01
+    deadline = time.monotonic() + lock_timeout
+    while time.monotonic() < deadline:
+        time.sleep(delay)
+        cached = get_cached_decision(request_hash)
+        if cached:
+            logger.info(f"Coalesced with in-flight request {request_hash}")
+            return cached
+        if cache.get(lock_key) is None:
+            # Lock released without a cached result (owner failed) - compute ourselves
+            break
+        delay = min(delay * 2, 0.5)
+    return compute_fn()
@@ -0,0 +1,88 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+
+from . import text_food_domain, text_injection, text_policy
+from .schemas import GuardrailResult
+
+# Shared pool for running independent guardrail checks concurrently (check_all and the engine)
+check_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="guardrail-check")
+
+
+def run_checks(pool, calls):
+    """
+    Run independent checks concurrently; returns (blocking_result, None) or (None, results).
+    calls is a list of (fn, *args). A BLOCK is reported only once every earlier check in the
+    list has passed, so the reason is the same as a serial run, but a BLOCK from an early check
+    returns without waiting for the slower ones. Checks that have not started yet are cancelled.
+    """
+    futures = [pool.submit(fn, *args) for fn, *args in calls]
+    try:
+        while True:
+            for future in futures:
+                if not future.done():
+                    wait([f for f in futures if not f.done()], return_when=FIRST_COMPLETED)
+                    break
+                if future.result().status == "BLOCK":
+                    return future.result(), None
+            else:
+                return None, [future.result() for future in futures]
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def _check_rules(text: str, text_lower: str):
+    """Cheap rule checks, injection then policy; returns the first BLOCK or None."""
+    res = text_injection.check_injection(text, text_lower=text_lower)
+    if res.status == "BLOCK":
+        return res
+    res = text_policy.check_policy(text, text_lower=text_lower)
+    if res.status == "BLOCK":
+        return res
+    return None
+
+
+def check_text(text: str) -> GuardrailResult:
+    """
+    Run the text guardrails in cost order: injection, policy, then food domain.
+    Stops at the first BLOCK, so rule-blocked prompts never reach the embedding model.
+    """
+    text_lower = text.lower()
+    blocked = _check_rules(text, text_lower)
+    if blocked is not None:
+        return blocked
+    return text_food_domain.check_food_domain(text, text_lower=text_lower)
+
+
+def check_all(text: str) -> GuardrailResult:
+    """
+    check_text with the three checks run concurrently, so latency is roughly the slowest
+    check instead of the sum. A BLOCK is returned once every higher-priority check has
+    passed (same reason as check_text); checks that have not started are cancelled.
+    """
+    text_lower = text.lower()
+    blocked, results = run_checks(check_pool, [
+        (partial(text_injection.check_injection, text_lower=text_lower), text),
+        (partial(text_policy.check_policy, text_lower=text_lower), text),
+        (partial(text_food_domain.check_food_domain, text_lower=text_lower), text),
+    ])
+    return blocked or results[-1]
+
+
+def check_text_batch(texts: list) -> list:
+    """
+    check_text for several prompts: rule checks run per prompt, and only the prompts they
+    pass go to one batched food-domain check. Returns one result per input, in order.
+    """
+    results = [None] * len(texts)
+    remaining = []
+    for i, text in enumerate(texts):
+        results[i] = _check_rules(text, text.lower())
+        if results[i] is None:
+            remaining.append(i)
+
+    if remaining:
+        domain_results = text_food_domain.check_food_domain_batch([texts[i] for i in remaining])
+        for i, res in zip(remaining, domain_results):
+            results[i] = res
+    return results
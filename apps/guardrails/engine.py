@@ -1,6 +1,9 @@
+import hashlib
 import logging
+from functools import partial
 from typing import Optional
 from django.conf import settings
+from .matcher import build_automaton
 from .schemas import GuardrailResult
 from . import (
     text_injection,
@@ -8,7 +11,8 @@ from . import (
     text_food_domain,
     image_hygiene,
     image_food_clip,
-    cache
+    cache,
+    composite
 )
 
 logger = logging.getLogger(__name__)
@@ -21,6 +25,9 @@ IMAGE_ANALYSIS_PROMPT_PATTERNS = [
     "create image with this image in center",
 ]
 
+# Patterns lower-cased once and compiled into one automaton: detection is a single pass over the prompt
+_image_analysis_automaton = build_automaton(p.lower() for p in IMAGE_ANALYSIS_PROMPT_PATTERNS)
+
 class GuardrailEngine:
     def _is_image_analysis_use_case(self, prompt: str, image_bytes: Optional[bytes]) -> bool:
         """
@@ -30,10 +37,10 @@ class GuardrailEngine:
         if not image_bytes:
             return False
         
-        prompt_lower = prompt.lower().strip()
-        return any(pattern.lower() in prompt_lower for pattern in IMAGE_ANALYSIS_PROMPT_PATTERNS)
+        return any(True for _ in _image_analysis_automaton.iter(prompt.lower()))
     
-    def process_image_analysis(self, prompt: str, image_bytes: bytes, request_hash: str) -> GuardrailResult:
+    def process_image_analysis(self, prompt: str, image_bytes: bytes, request_hash: str,
+                               image_hash: Optional[str] = None) -> GuardrailResult:
         """
         Use Case 1: Analyze the uploaded image for food context.
         Prompt is expected to be "generate image with this image attached in center of the background".
@@ -55,7 +62,7 @@ class GuardrailEngine:
         
         # 2. Food CLIP Check - Handles food detection, NSFW detection, AND food type identification
         # identify_type=True ensures we get what kind of food it is (pizza, cake, etc.)
-        res = image_food_clip.check_food_clip(pil_image, identify_type=True)
+        res = image_food_clip.check_food_clip(pil_image, identify_type=True, image_hash=image_hash)
         if res.status == "BLOCK":
             return self._block(res.reasons, request_hash, res.scores)
         
@@ -87,7 +94,8 @@ class GuardrailEngine:
         
         return final_result
     
-    def process_prompt_analysis(self, prompt: str, image_bytes: Optional[bytes], request_hash: str) -> GuardrailResult:
+    def process_prompt_analysis(self, prompt: str, image_bytes: Optional[bytes], request_hash: str,
+                                image_hash: Optional[str] = None) -> GuardrailResult:
         """
         Use Case 2: Analyze user prompt for generating images.
         Focus: Check prompt for restrictions and food domain context.
@@ -104,40 +112,29 @@ class GuardrailEngine:
         if len(prompt) > settings.GUARDRAILS_MAX_PROMPT_CHARS:
             return self._block("Prompt too long", request_hash)
 
-        # 2. Text Injection
-        res = text_injection.check_injection(prompt)
-        if res.status == "BLOCK":
-            return self._block(res.reasons, request_hash)
+        # 2-5. Text Injection, Text Policy, Food Domain (Text) and the OPTIONAL image check are
+        # independent, so run them concurrently. Both prompt AND image must pass for approval.
+        # The text checks all match on the lowercased prompt; lowercase it once for all of them
+        prompt_lower = prompt.lower()
+        checks = [
+            (partial(text_injection.check_injection, text_lower=prompt_lower), prompt),
+            (partial(text_policy.check_policy, text_lower=prompt_lower), prompt),
+            (partial(text_food_domain.check_food_domain, text_lower=prompt_lower), prompt),
+        ]
+        if image_bytes:
+            logger.info("Use Case 2: Validating optional image attachment")
+            checks.append((self._check_optional_image, image_bytes, image_hash))
 
-        # 3. Text Policy
-        res = text_policy.check_policy(prompt)
-        if res.status == "BLOCK":
-            return self._block(res.reasons, request_hash)
+        blocked, results = composite.run_checks(composite.check_pool, checks)
+        if blocked:
+            return self._block(blocked.reasons, request_hash, blocked.scores)
+
+        combined_scores.update(results[2].scores)
 
-        # 4. Food Domain (Text) - Main check for business context
-        res = text_food_domain.check_food_domain(prompt)
-        if res.status == "BLOCK":
-            return self._block(res.reasons, request_hash, res.scores)
-        
-        combined_scores.update(res.scores)
-        
-        # 5. OPTIONAL: If image is provided, validate it too
-        # Both prompt AND image must pass for approval
         if image_bytes:
-            logger.info("Use Case 2: Validating optional image attachment")
-            
-            # 5a. Image Hygiene Check
-            res = image_hygiene.check_hygiene(image_bytes)
-            if res.status == "BLOCK":
-                return self._block(["Image validation failed: " + r for r in res.reasons], request_hash)
-            
+            res = results[3]
             pil_image = res.metadata.get("pil_image")
             
-            # 5b. Food CLIP Check with food type identification
-            res = image_food_clip.check_food_clip(pil_image, identify_type=True)
-            if res.status == "BLOCK":
-                return self._block(["Image validation failed: " + r for r in res.reasons], request_hash, res.scores)
-            
             # Add image scores with prefix to distinguish from prompt scores
             combined_scores["image_food_score"] = res.scores.get("food_score", 0)
             combined_scores["image_non_food_score"] = res.scores.get("non_food_score", 0)
@@ -172,7 +169,29 @@ class GuardrailEngine:
         
         return final_result
     
-    def process_request(self, prompt: str, image_bytes: Optional[bytes] = None) -> GuardrailResult:
+    def _check_optional_image(self, image_bytes: bytes, image_hash: Optional[str]) -> GuardrailResult:
+        """Use Case 2 image validation: hygiene, then food CLIP check with food type identification."""
+        # 5a. Image Hygiene Check
+        res = image_hygiene.check_hygiene(image_bytes)
+        if res.status == "BLOCK":
+            return GuardrailResult(status="BLOCK", reasons=["Image validation failed: " + r for r in res.reasons])
+        
+        pil_image = res.metadata.get("pil_image")
+        
+        # 5b. Food CLIP Check with food type identification
+        res = image_food_clip.check_food_clip(pil_image, identify_type=True, image_hash=image_hash)
+        if res.status == "BLOCK":
+            return GuardrailResult(
+                status="BLOCK",
+                reasons=["Image validation failed: " + r for r in res.reasons],
+                scores=res.scores
+            )
+        
+        res.metadata["pil_image"] = pil_image
+        return res
+
+    def process_request(self, prompt: str, image_bytes: Optional[bytes] = None,
+                        image_hash: Optional[str] = None) -> GuardrailResult:
         """
         Main entry point for the guardrail pipeline.
         Routes to appropriate use case:
@@ -182,26 +201,50 @@ class GuardrailEngine:
         - Use Case 2: Prompt analysis (analyze user prompts for restrictions)
           - Validates prompt is food-related
           - If optional image provided, BOTH must pass validation
+        image_hash is the image's hex SHA-256 when the caller already computed it.
         Returns a GuardrailResult with status="PASS" or "BLOCK".
         """
         
         # 0. Compute Hash & Check Cache
-        image_hash = None
+        image_digest = None
         if image_bytes:
-            import hashlib
-            image_hash = hashlib.sha256(image_bytes).hexdigest()
+            if image_hash:
+                image_digest = bytes.fromhex(image_hash)
+            else:
+                image_digest = hashlib.sha256(image_bytes).digest()
+                image_hash = image_digest.hex()
+        else:
+            image_hash = None
             
-        request_hash = cache.compute_hash(prompt, image_hash)
-        cached_result = cache.get_cached_decision(request_hash)
-        if cached_result:
-            logger.info(f"Cache hit for {request_hash}")
-            return cached_result
+        request_hash = cache.compute_hash(prompt, image_digest)
+        # Concurrent identical requests share one pipeline run instead of all missing the cache
+        result = cache.get_or_compute(
+            request_hash, lambda: self._route(prompt, image_bytes, request_hash, image_hash)
+        )
+        if result.status == "PASS" and "use_case" not in result.metadata:
+            self._restore_metadata(result, prompt, image_bytes)
+        return result
+
+    def _restore_metadata(self, result: GuardrailResult, prompt: str, image_bytes: Optional[bytes]):
+        """
+        Cached and coalesced decisions carry scores only. Restore the use case and the decoded
+        image, which the caller needs to build the Gemini request.
+        """
+        is_image_analysis = self._is_image_analysis_use_case(prompt, image_bytes)
+        result.metadata["use_case"] = "image_analysis" if is_image_analysis else "prompt_analysis"
+        if image_bytes:
+            # Already passed hygiene when the decision was made; this only re-decodes it
+            result.metadata["pil_image"] = image_hygiene.check_hygiene(image_bytes).metadata.get("pil_image")
+        if not is_image_analysis:
+            result.metadata["has_image"] = bool(image_bytes)
 
-        # Route to appropriate use case
+    def _route(self, prompt: str, image_bytes: Optional[bytes], request_hash: str,
+               image_hash: Optional[str]) -> GuardrailResult:
+        """Route to appropriate use case."""
         if self._is_image_analysis_use_case(prompt, image_bytes):
-            return self.process_image_analysis(prompt, image_bytes, request_hash)
+            return self.process_image_analysis(prompt, image_bytes, request_hash, image_hash)
         else:
-            return self.process_prompt_analysis(prompt, image_bytes, request_hash)
+            return self.process_prompt_analysis(prompt, image_bytes, request_hash, image_hash)
 
     def _block(self, reasons, request_hash, scores=None):
         if isinstance(reasons, str):
@@ -1,16 +1,47 @@
-import torch
-import open_clip
+import hashlib
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING
+import numpy as np
 from PIL import Image
+from django.conf import settings
+from django.core.cache import cache
 from .schemas import GuardrailResult
 import logging
 
+# torch and open_clip are imported inside the functions that need them, so importing this
+# module (Django startup, text-only workers) doesn't pay torch's import cost
+if TYPE_CHECKING:
+    import torch
+
 logger = logging.getLogger(__name__)
 
+CLIP_MODEL_NAME = 'ViT-B-32'
+CLIP_PRETRAINED = 'laion2b_s34b_b79k'
+
 _model = None
 _preprocess = None
 _tokenizer = None
-# Cache for pre-computed text features (speeds up inference significantly)
-_text_features_cache = {}
+# Dtype the torch vision tower runs in (bfloat16 when GUARDRAILS_CLIP_PRECISION == "bf16")
+_visual_dtype = None
+# ONNX Runtime session for the vision tower (only when GUARDRAILS_CLIP_BACKEND == "onnx")
+_onnx_session = None
+# Guards the one-time model load so concurrent first requests don't double-load
+_model_lock = threading.Lock()
+# Micro-batcher for concurrent encode requests (only when GUARDRAILS_CLIP_BATCH_WINDOW_MS > 0)
+_batcher = None
+_batcher_lock = threading.Lock()
+# Cache for pre-computed text features (speeds up inference significantly).
+# LRU-bounded in memory and persisted under GUARDRAILS_CACHE_DIR across restarts.
+_text_features_cache = OrderedDict()
+_TEXT_FEATURES_CACHE_SIZE = 16
+# Storage dtype for cached text features (FP16 when the CPU build supports half matmuls)
+_text_features_dtype = None
 
 POS_LABELS = ["a photo of food", "a meal", "a dish", "ingredients", "cooking"]
 # Enhanced negative labels: NSFW, violence, and non-food content
@@ -59,74 +90,420 @@ FOOD_TYPE_LABELS = [
     "tacos", "burritos", "quesadilla", "wrap",
     "rice", "fried food", "appetizer", "main course", "dessert"
 ]
+FOOD_TYPE_PROMPTS = [f"a photo of {food}" for food in FOOD_TYPE_LABELS]
+# Validation and food-type prompts share one cached feature bank, so a single image encode
+# and a single matmul score both; the first N_VAL rows are the validation labels
+CLIP_PROMPTS = POS_LABELS + NEG_LABELS + FOOD_TYPE_PROMPTS
+N_POS = len(POS_LABELS)
+N_VAL = N_POS + len(NEG_LABELS)
+# Versions cached CLIP decisions: changing the weights, runtime, precision or any label
+# invalidates them (int8/ONNX/bf16 scores differ slightly from fp32 torch)
+_DECISION_VERSION = hashlib.sha256(repr((
+    CLIP_MODEL_NAME, CLIP_PRETRAINED, CLIP_PROMPTS, settings.GUARDRAILS_CLIP_BACKEND,
+    settings.GUARDRAILS_CLIP_PRECISION, settings.GUARDRAILS_CLIP_CALIBRATION_DIR,
+)).encode()).hexdigest()[:16]
+# NEG_LABELS indices reported as NSFW, resolved once instead of string-matching per request
+_NSFW_TERMS = ("nude", "naked", "porn", "sexual", "adult")
+_NSFW_NEG_INDICES = frozenset(
+    i for i, label in enumerate(NEG_LABELS) if any(term in label.lower() for term in _NSFW_TERMS)
+)
+
+CLIP_IMAGE_SIZE = 224
+# open_clip's OPENAI_DATASET_MEAN/STD (used by the laion2b ViT-B-32 weights), pre-scaled to 0-255
+# so normalisation works directly on uint8 pixel values without a separate /255 pass
+_PIXEL_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32) * 255
+_PIXEL_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32) * 255
+
+def _calibration_reader(image_dir):
+    """ONNX Runtime calibration reader feeding preprocessed images from image_dir."""
+    from onnxruntime.quantization import CalibrationDataReader
+
+    class _Reader(CalibrationDataReader):
+        def __init__(self, paths):
+            self._paths = iter(paths)
+
+        def get_next(self):
+            path = next(self._paths, None)
+            if path is None:
+                return None
+            with Image.open(path) as img:
+                return {"image": _preprocess_np(img).numpy()}
+
+    paths = sorted(p for p in Path(image_dir).iterdir() if p.suffix.lower() in {'.jpg', '.jpeg', '.png', '.webp'})
+    return _Reader(paths)
+
+
+def _quantize_onnx_visual(fp32_path, int8_path):
+    """
+    Post-training INT8 quantization of the exported vision tower.
+    Static (QDQ, calibrated on GUARDRAILS_CLIP_CALIBRATION_DIR) when calibration images are
+    configured, dynamic otherwise.
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic, quantize_static
+
+    calibration_dir = settings.GUARDRAILS_CLIP_CALIBRATION_DIR
+    logger.info(f"Quantizing CLIP vision encoder to {int8_path}")
+    # Quantize to a temp file and rename, so a partial model is never left at int8_path
+    tmp_path = int8_path.with_suffix(f".{os.getpid()}.tmp")
+    if calibration_dir:
+        quantize_static(str(fp32_path), str(tmp_path), _calibration_reader(calibration_dir),
+                        weight_type=QuantType.QInt8)
+    else:
+        quantize_dynamic(str(fp32_path), str(tmp_path), weight_type=QuantType.QInt8)
+    os.replace(tmp_path, int8_path)
+
+
+def _load_onnx_visual(model):
+    """Export the vision tower to ONNX once (INT8-quantized if configured), then open it with ONNX Runtime."""
+    import onnxruntime as ort
+    import torch
+
+    onnx_path = settings.GUARDRAILS_CLIP_ONNX_PATH
+    if not onnx_path.exists():
+        logger.info(f"Exporting CLIP vision encoder to {onnx_path}")
+        onnx_path.parent.mkdir(parents=True, exist_ok=True)
+        # Export beside the target and rename, so concurrent workers or an interrupted export
+        # never leave a truncated model at onnx_path
+        tmp_path = onnx_path.with_suffix(f".{os.getpid()}.tmp")
+        torch.onnx.export(
+            model.visual,
+            torch.zeros(1, 3, 224, 224),
+            str(tmp_path),
+            opset_version=17,
+            input_names=["image"],
+            output_names=["features"],
+            dynamic_axes={"image": {0: "B"}, "features": {0: "B"}},
+        )
+        os.replace(tmp_path, onnx_path)
+
+    if settings.GUARDRAILS_CLIP_PRECISION == 'int8':
+        int8_path = onnx_path.with_suffix('.int8.onnx')
+        if not int8_path.exists():
+            _quantize_onnx_visual(onnx_path, int8_path)
+        onnx_path = int8_path
+
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess_options.intra_op_num_threads = settings.GUARDRAILS_CLIP_THREADS
+    return ort.InferenceSession(str(onnx_path), sess_options=sess_options, providers=["CPUExecutionProvider"])
+
+
+def _cpu_supports_bf16() -> bool:
+    """True when the CPU has native BF16 dot products (AVX512-BF16 / AMX)."""
+    import torch
+    check = getattr(torch.cpu, "_is_avx512_bf16_supported", None)
+    return bool(check and check())
+
+
+def _compile_visual(visual):
+    """
+    Specialise the vision tower for its fixed 3x224x224 input with torch.compile (Inductor),
+    falling back to a TorchScript trace, and run one warm-up pass so the compile happens at
+    load time rather than in the first request.
+    """
+    import torch
+    example = torch.zeros(1, 3, CLIP_IMAGE_SIZE, CLIP_IMAGE_SIZE, dtype=_visual_dtype)
+    # The batch dimension only varies when the micro-batcher is on
+    dynamic = None if settings.GUARDRAILS_CLIP_BATCH_WINDOW_MS > 0 else False
+    try:
+        compiled = torch.compile(visual, dynamic=dynamic)
+        # Warm up under the same grad mode requests use, so the compiled graph is reused
+        with torch.inference_mode():
+            compiled(example)
+    except Exception as e:
+        logger.warning(f"torch.compile failed for CLIP ({e}), falling back to torch.jit.trace")
+        with torch.no_grad():
+            compiled = torch.jit.trace(visual, example)
+            compiled(example)
+    return compiled
+
 
 def get_clip_model():
-    global _model, _preprocess, _tokenizer
+    global _model, _preprocess, _tokenizer, _onnx_session, _visual_dtype
+    import open_clip
+    import torch
+
     if _model is None:
-        # Use a small model for CPU
-        _model, _, _preprocess = open_clip.create_model_and_transforms('ViT-B-32', pretrained='laion2b_s34b_b79k')
-        _tokenizer = open_clip.get_tokenizer('ViT-B-32')
-        # Set model to eval mode for faster inference
-        _model.eval()
+        with _model_lock:
+            if _model is None:
+                # Cap intra-op threads so concurrent workers don't oversubscribe the CPU
+                torch.set_num_threads(settings.GUARDRAILS_CLIP_THREADS)
+                _visual_dtype = torch.float32
+                try:
+                    # Requests are already parallel across workers; one inter-op thread is enough
+                    torch.set_num_interop_threads(1)
+                except RuntimeError:
+                    # Only settable before the first inter-op parallel work in the process
+                    pass
+                # Use a small model for CPU
+                model, _, preprocess = open_clip.create_model_and_transforms(CLIP_MODEL_NAME, pretrained=CLIP_PRETRAINED)
+                _tokenizer = open_clip.get_tokenizer(CLIP_MODEL_NAME)
+                # Set model to eval mode for faster inference
+                model.eval()
+                model.requires_grad_(False)
+                if settings.GUARDRAILS_CLIP_BACKEND == 'onnx':
+                    _onnx_session = _load_onnx_visual(model)
+                elif settings.GUARDRAILS_CLIP_PRECISION == 'int8':
+                    # Run the vision tower's Linear layers as int8 GEMMs (FBGEMM/oneDNN).
+                    # The text tower stays FP32, so cached text features are unaffected.
+                    model.visual = torch.ao.quantization.quantize_dynamic(
+                        model.visual, {torch.nn.Linear}, dtype=torch.qint8
+                    )
+                elif settings.GUARDRAILS_CLIP_PRECISION == 'bf16':
+                    if _cpu_supports_bf16():
+                        # Only the vision tower: text features stay FP32
+                        model.visual.to(torch.bfloat16)
+                        _visual_dtype = torch.bfloat16
+                    else:
+                        logger.warning("CLIP_PRECISION=bf16 but the CPU lacks BF16 support, using fp32")
+                if settings.GUARDRAILS_CLIP_COMPILE and _onnx_session is None:
+                    model.visual = _compile_visual(model.visual)
+                _preprocess = preprocess
+                _model = model
     return _model, _preprocess, _tokenizer
 
 
+def preload_clip_model():
+    """
+    Load CLIP and pre-compute the label text features ahead of the first request.
+    Called from the Celery worker_process_init signal so tasks only run the image encoder.
+    """
+    get_clip_model()
+    _get_prompt_features()
+    logger.info("CLIP model preloaded")
+
+
+def _resize_crop(pil_image: Image.Image) -> np.ndarray:
+    """
+    Geometric half of open_clip's preprocess: bicubic resize of the shortest side, center crop.
+    Returns 224x224x3 uint8 pixels.
+    """
+    img = pil_image if pil_image.mode == 'RGB' else pil_image.convert('RGB')
+
+    w, h = img.size
+    if w <= h:
+        new_w, new_h = CLIP_IMAGE_SIZE, int(CLIP_IMAGE_SIZE * h / w)
+    else:
+        new_w, new_h = int(CLIP_IMAGE_SIZE * w / h), CLIP_IMAGE_SIZE
+    img = img.resize((new_w, new_h), Image.BICUBIC)
+
+    left = int(round((new_w - CLIP_IMAGE_SIZE) / 2.0))
+    top = int(round((new_h - CLIP_IMAGE_SIZE) / 2.0))
+    img = img.crop((left, top, left + CLIP_IMAGE_SIZE, top + CLIP_IMAGE_SIZE))
+    return np.asarray(img, dtype=np.uint8)
+
+
+def _normalize(pixels: np.ndarray) -> "torch.Tensor":
+    """Normalize 224x224x3 (or Nx224x224x3) uint8 pixels into an Nx3x224x224 float tensor."""
+    import torch
+    if pixels.ndim == 3:
+        pixels = pixels[np.newaxis]
+    arr = pixels.astype(np.float32)
+    arr -= _PIXEL_MEAN
+    arr /= _PIXEL_STD
+    return torch.from_numpy(np.ascontiguousarray(arr.transpose(0, 3, 1, 2)))
+
+
+def _preprocess_np(pil_image: Image.Image) -> "torch.Tensor":
+    """Vectorised equivalent of open_clip's preprocess (resize, center crop, normalize)."""
+    return _normalize(_resize_crop(pil_image))
+
+
+def _run_image_encoder(model, images):
+    """Run the vision tower through ONNX Runtime when configured, else PyTorch."""
+    import torch
+    if _onnx_session is not None:
+        return torch.from_numpy(_onnx_session.run(None, {"image": images.numpy()})[0])
+    # Features come back as FP32 so the similarity matmul and softmax stay in full precision
+    return model.encode_image(images.to(_visual_dtype)).float()
+
+
+class _ImageBatcher:
+    """
+    Coalesces concurrent encode requests into a single batched forward pass.
+    Requests arriving within max_wait seconds of the first one share a batch of up to max_batch.
+    Only helps when several tasks run per process (Celery --pool=threads).
+    """
+
+    def __init__(self, max_batch: int, max_wait: float):
+        self._max_batch = max_batch
+        self._max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="clip-batcher", daemon=True)
+        self._thread.start()
+
+    def encode(self, image):
+        future = Future()
+        self._queue.put((image, future))
+        return future.result()
+
+    def _collect(self):
+        items = [self._queue.get()]
+        deadline = time.monotonic() + self._max_wait
+        while len(items) < self._max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        import torch
+        while True:
+            items = self._collect()
+            try:
+                model, _, _ = get_clip_model()
+                with torch.inference_mode():
+                    features = _run_image_encoder(model, torch.cat([image for image, _ in items]))
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+            for i, (_, future) in enumerate(items):
+                future.set_result(features[i:i + 1])
+
+
+def _get_batcher():
+    global _batcher
+    if _batcher is None and settings.GUARDRAILS_CLIP_BATCH_WINDOW_MS > 0:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = _ImageBatcher(
+                    max_batch=settings.GUARDRAILS_CLIP_MAX_BATCH,
+                    max_wait=settings.GUARDRAILS_CLIP_BATCH_WINDOW_MS / 1000.0,
+                )
+    return _batcher
+
+
+def _encode_image(model, image):
+    """Encode a preprocessed image, through the micro-batcher when enabled."""
+    batcher = _get_batcher()
+    if batcher is not None:
+        return batcher.encode(image)
+    return _run_image_encoder(model, image)
+
+
+def _get_text_features_dtype():
+    """FP16 when this torch build can run half-precision matmuls on CPU, FP32 otherwise."""
+    import torch
+    global _text_features_dtype
+    if _text_features_dtype is None:
+        try:
+            torch.ones(1, 8, dtype=torch.float16) @ torch.ones(8, 2, dtype=torch.float16)
+            _text_features_dtype = torch.float16
+        except RuntimeError:
+            _text_features_dtype = torch.float32
+    return _text_features_dtype
+
+
+def _text_features_path(labels: list) -> Path:
+    """On-disk location of the text features for a label set, keyed by model and labels."""
+    digest = hashlib.sha256(repr((CLIP_MODEL_NAME, CLIP_PRETRAINED, tuple(labels))).encode()).hexdigest()
+    return Path(settings.GUARDRAILS_CACHE_DIR) / f"clip_text_{digest}.npy"
+
+
 def _get_cached_text_features(labels: list, cache_key: str):
-    """Get cached text features or compute and cache them."""
-    global _text_features_cache
-    if cache_key not in _text_features_cache:
+    """
+    Get cached text features or compute and cache them.
+    Entries are keyed on the label set too, so editing a label list invalidates its features.
+    Computed features are also saved to disk so restarted workers skip the text encoder.
+    """
+    import torch
+    key = (cache_key, tuple(labels))
+    if key in _text_features_cache:
+        _text_features_cache.move_to_end(key)
+        return _text_features_cache[key]
+
+    path = _text_features_path(labels)
+    if path.exists():
+        text_features = torch.from_numpy(np.load(path))
+    else:
         model, _, tokenizer = get_clip_model()
         text = tokenizer(labels)
-        with torch.no_grad():
+        with torch.inference_mode():
             text_features = model.encode_text(text)
             text_features /= text_features.norm(dim=-1, keepdim=True)
-        _text_features_cache[cache_key] = text_features
-    return _text_features_cache[cache_key]
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_path, 'wb') as f:
+                np.save(f, text_features.float().numpy())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not persist CLIP text features to {path}: {e}")
+
+    # Stored in FP16 to halve the bytes the per-image matmul reads
+    _text_features_cache[key] = text_features.to(_get_text_features_dtype()).contiguous()
+    if len(_text_features_cache) > _TEXT_FEATURES_CACHE_SIZE:
+        _text_features_cache.popitem(last=False)
+    return _text_features_cache[key]
+
+
+def _get_prompt_features():
+    """Cached text features for CLIP_PROMPTS: validation labels first, then food types."""
+    return _get_cached_text_features(CLIP_PROMPTS, "prompts")
+
+
+def _encode_normalized(model, pil_image: Image.Image):
+    """Preprocess and encode an image; returns L2-normalised image features."""
+    image = _preprocess_np(pil_image)
+    image_features = _encode_image(model, image)
+    image_features /= image_features.norm(dim=-1, keepdim=True)
+    return image_features
+
 
+def _similarity_logits(image_features, text_features):
+    """Scaled cosine logits, computed in the text features' dtype and returned as FP32."""
+    return (100.0 * image_features.to(text_features.dtype) @ text_features.T).float()
 
-def identify_food_type(pil_image: Image.Image) -> dict:
+
+def _describe_food_type(food_probs) -> dict:
+    """Build the food identification result from probabilities over FOOD_TYPE_LABELS."""
+    # Get top 3 matches for detailed results (partial sort; only 3 values leave the tensor)
+    top_vals, top_idx = food_probs.topk(3)
+    top_vals, top_idx = top_vals.tolist(), top_idx.tolist()
+    top_matches = [
+        {"food_type": FOOD_TYPE_LABELS[i], "confidence": round(p * 100, 2)}
+        for i, p in zip(top_idx, top_vals)
+    ]
+    
+    # Best match
+    best_food = FOOD_TYPE_LABELS[top_idx[0]]
+    best_confidence = top_vals[0]
+    
+    logger.info(f"Food identified as: {best_food} (confidence: {best_confidence:.2%})")
+    
+    return {
+        "food_type": best_food,
+        "confidence": round(best_confidence * 100, 2),
+        "top_matches": top_matches
+    }
+
+
+def identify_food_type(pil_image: Image.Image, image_features=None) -> dict:
     """
     Identify the type of food in the image using CLIP.
     Returns dict with 'food_type', 'confidence', and 'top_matches'.
-    This is called AFTER the image passes food validation for efficiency.
+    Pass already-normalised image_features to skip the image encode.
     """
+    import torch
     try:
-        model, preprocess, _ = get_clip_model()
-        
-        image = preprocess(pil_image).unsqueeze(0)
+        model, _, _ = get_clip_model()
         
         # Get cached food type text features (pre-computed for speed)
-        food_labels_for_clip = [f"a photo of {food}" for food in FOOD_TYPE_LABELS]
-        text_features = _get_cached_text_features(food_labels_for_clip, "food_types")
+        text_features = _get_prompt_features()[N_VAL:]
         
-        with torch.no_grad():
-            image_features = model.encode_image(image)
-            image_features /= image_features.norm(dim=-1, keepdim=True)
+        with torch.inference_mode():
+            if image_features is None:
+                image_features = _encode_normalized(model, pil_image)
             
             # Compute similarities
-            similarities = (100.0 * image_features @ text_features.T).softmax(dim=-1)
+            similarities = _similarity_logits(image_features, text_features).softmax(dim=-1)
             
-        probs = similarities[0].tolist()
-        
-        # Get top 3 matches for detailed results
-        top_indices = sorted(range(len(probs)), key=lambda i: probs[i], reverse=True)[:3]
-        top_matches = [
-            {"food_type": FOOD_TYPE_LABELS[i], "confidence": round(probs[i] * 100, 2)}
-            for i in top_indices
-        ]
-        
-        # Best match
-        best_idx = top_indices[0]
-        best_food = FOOD_TYPE_LABELS[best_idx]
-        best_confidence = probs[best_idx]
-        
-        logger.info(f"Food identified as: {best_food} (confidence: {best_confidence:.2%})")
-        
-        return {
-            "food_type": best_food,
-            "confidence": round(best_confidence * 100, 2),
-            "top_matches": top_matches
-        }
+        return _describe_food_type(similarities[0])
         
     except Exception as e:
         logger.error(f"Food type identification failed: {e}")
@@ -138,67 +515,116 @@ def identify_food_type(pil_image: Image.Image) -> dict:
         }
 
 
-def check_food_clip(pil_image: Image.Image, margin: float = 0.1, identify_type: bool = True) -> GuardrailResult:
+def _clip_decision(logits, margin: float, identify_type: bool) -> GuardrailResult:
+    """PASS/BLOCK decision for one image from its logits over CLIP_PROMPTS."""
+    # Validation and food-type slices each get their own softmax
+    probs = logits[:N_VAL].softmax(dim=-1)
+    
+    # Reduce on the tensor; only the scalars we report cross into Python
+    max_pos = probs[:N_POS].max().item()
+    neg_max, neg_idx = probs[N_POS:].max(dim=0)
+    max_neg = neg_max.item()
+    
+    # Check if top label is positive AND margin is sufficient
+    # This also blocks NSFW content since negative labels include NSFW terms
+    if max_pos < max_neg + margin:
+        # Determine reason based on which negative label scored highest
+        neg_idx = neg_idx.item()
+        neg_label = NEG_LABELS[neg_idx]
+        
+        # Check if it's NSFW-related
+        is_nsfw = neg_idx in _NSFW_NEG_INDICES
+        
+        reason = f"NSFW content detected: {neg_label}" if is_nsfw else f"Image not clearly food (pos: {max_pos:.2f}, neg: {max_neg:.2f})"
+        return GuardrailResult(
+            status="BLOCK",
+            reasons=[reason],
+            scores={"food_score": max_pos, "non_food_score": max_neg, "top_negative_label": neg_label}
+        )
+    
+    # Image passed validation - now identify the food type if requested
+    scores = {"food_score": max_pos, "non_food_score": max_neg}
+    metadata = {}
+    
+    if identify_type:
+        food_info = _describe_food_type(logits[N_VAL:].softmax(dim=-1))
+        scores["identified_food"] = food_info["food_type"]
+        scores["food_type_confidence"] = food_info["confidence"]
+        metadata["food_identification"] = food_info
+        
+    return GuardrailResult(
+        status="PASS",
+        scores=scores,
+        metadata=metadata
+    )
+
+
+def check_food_clip(pil_image: Image.Image, margin: float = 0.1, identify_type: bool = True,
+                    image_hash: str = None) -> GuardrailResult:
     """
     Check if image is food-related using CLIP.
     Also detects NSFW content via negative labels, eliminating need for separate NSFW detector.
-    If identify_type is True, also identifies the specific food type.
+    If identify_type is True, also identifies the specific food type from the same image encode.
+    With image_hash, decisions are cached so re-uploads of the same image skip the encoder.
     """
+    import torch
+    result_key = None
+    if image_hash:
+        result_key = f"clip_result:{_DECISION_VERSION}:{image_hash}:{margin}:{int(identify_type)}"
+        cached = cache.get(result_key)
+        if cached is not None:
+            return GuardrailResult(**cached)
+
     try:
-        model, preprocess, _ = get_clip_model()
-        
-        image = preprocess(pil_image).unsqueeze(0)
+        model, _, _ = get_clip_model()
         
-        # Get cached text features for validation (pre-computed for speed)
-        all_labels = POS_LABELS + NEG_LABELS
-        text_features = _get_cached_text_features(all_labels, "validation")
+        # Validation + food type text features (pre-computed for speed)
+        text_features = _get_prompt_features()
         
-        with torch.no_grad():
-            image_features = model.encode_image(image)
-            image_features /= image_features.norm(dim=-1, keepdim=True)
-            
-            text_probs = (100.0 * image_features @ text_features.T).softmax(dim=-1)
-            
-        probs = text_probs[0].tolist()
-        pos_probs = probs[:len(POS_LABELS)]
-        neg_probs = probs[len(POS_LABELS):]
-        
-        max_pos = max(pos_probs)
-        max_neg = max(neg_probs)
-        
-        # Check if top label is positive AND margin is sufficient
-        # This also blocks NSFW content since negative labels include NSFW terms
-        if max_pos < max_neg + margin:
-            # Determine reason based on which negative label scored highest
-            neg_label_idx = neg_probs.index(max_neg)
-            neg_label = NEG_LABELS[neg_label_idx]
-            
-            # Check if it's NSFW-related
-            nsfw_terms = ["nude", "naked", "porn", "sexual", "adult"]
-            is_nsfw = any(term in neg_label.lower() for term in nsfw_terms)
+        with torch.inference_mode():
+            image_features = _encode_normalized(model, pil_image)
             
-            reason = f"NSFW content detected: {neg_label}" if is_nsfw else f"Image not clearly food (pos: {max_pos:.2f}, neg: {max_neg:.2f})"
-            return GuardrailResult(
-                status="BLOCK",
-                reasons=[reason],
-                scores={"food_score": max_pos, "non_food_score": max_neg, "top_negative_label": neg_label}
-            )
+            # One matmul scores both label sets
+            logits = _similarity_logits(image_features, text_features)
+            result = _clip_decision(logits[0], margin, identify_type)
+
+    except Exception as e:
+        return GuardrailResult(status="BLOCK", reasons=[f"CLIP check failed: {str(e)}"])
+
+    if result_key:
+        cache.set(result_key, {
+            "status": result.status,
+            "reasons": result.reasons,
+            "scores": result.scores,
+            "metadata": result.metadata
+        }, 3600)
+    return result
+
+
+def check_food_clip_batch(pil_images: list, margin: float = 0.1, identify_type: bool = True) -> list:
+    """
+    check_food_clip for several images at once: preprocessing runs on a thread pool, then a
+    single stacked forward pass and matmul score every image. Returns one result per image.
+    """
+    import torch
+    if not pil_images:
+        return []
+    try:
+        model, _, _ = get_clip_model()
+        text_features = _get_prompt_features()
         
-        # Image passed validation - now identify the food type if requested
-        scores = {"food_score": max_pos, "non_food_score": max_neg}
-        metadata = {}
+        # Resize/crop in parallel (PIL releases the GIL), then stay uint8 until one
+        # vectorised normalize over the whole stack
+        workers = min(len(pil_images), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pixels = np.stack(list(pool.map(_resize_crop, pil_images)))
         
-        if identify_type:
-            food_info = identify_food_type(pil_image)
-            scores["identified_food"] = food_info["food_type"]
-            scores["food_type_confidence"] = food_info["confidence"]
-            metadata["food_identification"] = food_info
-            
-        return GuardrailResult(
-            status="PASS",
-            scores=scores,
-            metadata=metadata
-        )
+        with torch.inference_mode():
+            image_features = _run_image_encoder(model, _normalize(pixels))
+            image_features /= image_features.norm(dim=-1, keepdim=True)
+            logits = _similarity_logits(image_features, text_features)
+            return [_clip_decision(row, margin, identify_type) for row in logits]
 
     except Exception as e:
-        return GuardrailResult(status="BLOCK", reasons=[f"CLIP check failed: {str(e)}"])
+        return [GuardrailResult(status="BLOCK", reasons=[f"CLIP check failed: {str(e)}"])
+                for _ in pil_images]
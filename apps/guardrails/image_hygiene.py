@@ -17,14 +17,12 @@ def check_hygiene(image_bytes: bytes) -> GuardrailResult:
         if w * h > settings.GUARDRAILS_MAX_PIXELS:
              return GuardrailResult(status="BLOCK", reasons=["Image dimensions too large"])
              
-        # Strip EXIF (by creating new image)
-        data = list(img.getdata())
-        image_without_exif = Image.new(img.mode, img.size)
-        image_without_exif.putdata(data)
-        
         # Convert to RGB if needed
-        if image_without_exif.mode != 'RGB':
-            image_without_exif = image_without_exif.convert('RGB')
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+            
+        # Strip EXIF (by creating new image from the raw pixel buffer; metadata is not copied)
+        image_without_exif = Image.frombytes('RGB', img.size, img.tobytes())
             
         return GuardrailResult(status="PASS", metadata={"pil_image": image_without_exif})
         
@@ -0,0 +1,64 @@
+import re
+import threading
+import ahocorasick
+
+try:
+    import hyperscan
+except ImportError:  # optional: SIMD literal matching when the library is installed
+    hyperscan = None
+
+
+def build_automaton(terms) -> ahocorasick.Automaton:
+    """Compile literal terms into one Aho-Corasick automaton (each term maps to itself)."""
+    automaton = ahocorasick.Automaton()
+    for term in terms:
+        automaton.add_word(term, term)
+    automaton.make_automaton()
+    return automaton
+
+
+def find_terms(automaton: ahocorasick.Automaton, text: str, terms) -> list:
+    """Terms of `terms` occurring in text, in list order, from a single scan of text."""
+    matched = {term for _, term in automaton.iter(text)}
+    return [term for term in terms if term in matched]
+
+
+class TermMatcher:
+    """
+    Finds which of a fixed list of literal terms occur in a text with a single scan.
+    Uses a Hyperscan block-mode database when hyperscan is installed, else Aho-Corasick.
+    Matching is case-sensitive; callers pass lowercased text.
+    """
+
+    def __init__(self, terms):
+        self.terms = list(terms)
+        self._automaton = None
+        self._db = None
+        if hyperscan is not None:
+            self._db = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+            self._db.compile(
+                expressions=[re.escape(term).encode() for term in self.terms],
+                ids=list(range(len(self.terms))),
+                elements=len(self.terms),
+                flags=[hyperscan.HS_FLAG_SINGLEMATCH] * len(self.terms),
+            )
+            # Hyperscan scratch space can't be shared between concurrent scans
+            self._local = threading.local()
+        else:
+            self._automaton = build_automaton(self.terms)
+
+    def find(self, text: str) -> list:
+        """Terms occurring in text, in list order."""
+        if self._automaton is not None:
+            return find_terms(self._automaton, text, self.terms)
+
+        scratch = getattr(self._local, "scratch", None)
+        if scratch is None:
+            scratch = self._local.scratch = hyperscan.Scratch(self._db)
+        matched = set()
+
+        def on_match(term_id, start, end, flags, context):
+            matched.add(term_id)
+
+        self._db.scan(text.encode(), match_event_handler=on_match, scratch=scratch)
+        return [term for i, term in enumerate(self.terms) if i in matched]
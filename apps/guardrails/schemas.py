@@ -1,7 +1,7 @@
 from dataclasses import dataclass, field
 from typing import List, Dict, Any
 
-@dataclass
+@dataclass(slots=True)
 class GuardrailResult:
     status: str  # "PASS" or "BLOCK"
     reasons: List[str] = field(default_factory=list)
@@ -1,12 +1,32 @@
-from sentence_transformers import SentenceTransformer, util
+from django.conf import settings
+from django.core.cache import caches
+from .matcher import build_automaton
 from .schemas import GuardrailResult
+import hashlib
+import numpy as np
 import logging
+import os
 import re
+import threading
+from collections import OrderedDict
+from typing import Optional
 
 logger = logging.getLogger(__name__)
 
+MODEL_NAME = 'all-MiniLM-L6-v2'
+
 # Lazy load model
 _model = None
+# Guards the one-time load so a background warm-up and a request don't both load the model
+_model_lock = threading.Lock()
+# Stage B scores keyed on normalized prompt text, shared by the single and batch paths
+_score_cache = OrderedDict()
+_SCORE_CACHE_SIZE = 1024
+_score_cache_lock = threading.Lock()
+# Version tag for persisted scores (see _score_version)
+_score_version_tag = None
+# Normalized ALLOWLIST_INTENTS embeddings, computed once per process
+_intent_embs = None
 
 # Specific food items and food-related context keywords (strict matching)
 FOOD_ITEMS = [
@@ -29,6 +49,9 @@ FOOD_ITEMS = [
     "restaurant", "cafe", "bakery", "menu", "chef", "cuisine", "dish", "meal", "food"
 ]
 
+# Single-pass matcher over FOOD_ITEMS; reused by the pattern guards and Stage A
+_food_automaton = build_automaton(FOOD_ITEMS)
+
 # Patterns that indicate non-food content (fast block)
 # These patterns check for person/celebrity names without food context
 NON_FOOD_PATTERNS = [
@@ -36,6 +59,11 @@ NON_FOOD_PATTERNS = [
     r'\b(generate|create|make).*image.*of\s+(a\s+)?(celebrity|actor|actress|model|singer|artist)\b',
 ]
 
+# Compiled once at import; check_food_domain runs on every prompt
+_IMAGE_OF_RE = re.compile(r'\b(generate|create|make|show|display).*image.*of\s+(.+?)(?:\s|$)')
+_PERSON_RE = re.compile(r'\b(emma|watson|hitler|person|people|man|woman|celebrity|actor)\b')
+_NON_FOOD_RES = [re.compile(pattern) for pattern in NON_FOOD_PATTERNS]
+
 ALLOWLIST_INTENTS = [
     "write a recipe for pizza",
     "ingredients list for pasta",
@@ -55,31 +83,275 @@ ALLOWLIST_INTENTS = [
     "meal planning"
 ]
 
+# Stage B scores used instead of the encoder when GUARDRAILS_FAKE_MODEL is set (unit tests);
+# any other text scores 0.0
+_FAKE_SCORES = {
+    "how do i cook spaghetti": 0.8,
+    "ideas for a quick weeknight supper": 0.7,
+    "write a python script for sorting": 0.1,
+}
+
+class _OnnxSentenceEncoder:
+    """
+    SentenceTransformer-compatible encode() backed by an INT8 ONNX Runtime export of MiniLM:
+    tokenize -> session.run -> mean-pool -> optional L2 normalisation.
+    """
+
+    def __init__(self, session, tokenizer, max_seq_length):
+        self._session = session
+        self._tokenizer = tokenizer
+        self._max_seq_length = max_seq_length
+        self._input_names = [i.name for i in session.get_inputs()]
+
+    # Token-count bucket edges: a batch is run bucket by bucket so short prompts aren't padded
+    # to the longest one
+    LENGTH_BUCKETS = (8, 16, 32, 64)
+
+    def _embed(self, texts):
+        """Mean-pooled token embeddings for texts, padded to the longest of them."""
+        # A single prompt needs no padding; numpy outputs feed ORT without a torch round-trip
+        inputs = self._tokenizer(texts, padding=len(texts) > 1, truncation=True,
+                                 max_length=self._max_seq_length, return_tensors="np")
+        feed = {name: inputs[name].astype(np.int64) for name in self._input_names}
+        token_embeddings = self._session.run(None, feed)[0]
+
+        # Mean pooling over real tokens (same as the model's pooling module)
+        mask = inputs["attention_mask"][..., None].astype(np.float32)
+        return (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+    def encode(self, sentences, convert_to_tensor=False, normalize_embeddings=False):
+        single = isinstance(sentences, str)
+        batch = [sentences] if single else list(sentences)
+        if len(batch) == 1:
+            embeddings = self._embed(batch)
+        else:
+            lengths = [len(ids) for ids in self._tokenizer(
+                batch, truncation=True, max_length=self._max_seq_length)["input_ids"]]
+            buckets = np.digitize(lengths, self.LENGTH_BUCKETS, right=True)
+            embeddings = None
+            for bucket in np.unique(buckets):
+                indices = np.flatnonzero(buckets == bucket)
+                bucket_embeddings = self._embed([batch[i] for i in indices])
+                if embeddings is None:
+                    embeddings = np.empty((len(batch), bucket_embeddings.shape[1]), dtype=bucket_embeddings.dtype)
+                embeddings[indices] = bucket_embeddings
+
+        if normalize_embeddings:
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        if single:
+            embeddings = embeddings[0]
+        if convert_to_tensor:
+            import torch
+            return torch.from_numpy(embeddings)
+        return embeddings
+
+
+def _load_onnx_encoder(st_model):
+    """Export MiniLM to ONNX and INT8-quantize it once, then open it with ONNX Runtime."""
+    import onnxruntime as ort
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    onnx_path = settings.GUARDRAILS_TEXT_ONNX_PATH
+    int8_path = onnx_path.with_suffix('.int8.onnx')
+    if not int8_path.exists():
+        if not onnx_path.exists():
+            logger.info(f"Exporting MiniLM encoder to {onnx_path}")
+            onnx_path.parent.mkdir(parents=True, exist_ok=True)
+            dummy = st_model.tokenizer(["a photo of food"], return_tensors="pt")
+            input_names = ["input_ids", "attention_mask", "token_type_ids"]
+            dynamic_axes = {name: {0: "B", 1: "T"} for name in input_names}
+            dynamic_axes["token_embeddings"] = {0: "B", 1: "T"}
+            # Both files are written to a temp path and renamed, so racing processes or an
+            # interrupted export never leave a truncated model behind the exists() checks
+            tmp_path = onnx_path.with_suffix(f".{os.getpid()}.tmp")
+            torch.onnx.export(
+                st_model[0].auto_model,
+                tuple(dummy[name] for name in input_names),
+                str(tmp_path),
+                opset_version=17,
+                input_names=input_names,
+                output_names=["token_embeddings"],
+                dynamic_axes=dynamic_axes,
+            )
+            os.replace(tmp_path, onnx_path)
+        logger.info(f"Quantizing MiniLM encoder to {int8_path}")
+        tmp_path = int8_path.with_suffix(f".{os.getpid()}.tmp")
+        quantize_dynamic(str(onnx_path), str(tmp_path), weight_type=QuantType.QInt8)
+        os.replace(tmp_path, int8_path)
+
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(str(int8_path), sess_options=sess_options, providers=["CPUExecutionProvider"])
+
+
+def _ensure_fast_tokenizer(st_model):
+    """Swap in the Rust (fast) tokenizer if the model came with the pure-Python one."""
+    tokenizer = st_model.tokenizer
+    if not tokenizer.is_fast:
+        from transformers import AutoTokenizer
+        logger.info("Replacing slow food-domain tokenizer with the fast implementation")
+        st_model.tokenizer = AutoTokenizer.from_pretrained(tokenizer.name_or_path, use_fast=True)
+
+def _compile_encoder(st_model):
+    """
+    torch.compile the MiniLM transformer in place and warm it up, so compilation happens at
+    load time. Shapes are dynamic: prompt lengths vary and padding every prompt to the model's
+    max length would cost more than the compile saves. On a GPU, "reduce-overhead" replays
+    captured CUDA graphs, since a single-prompt forward there is bound by kernel launches.
+    """
+    import torch
+    transformer = st_model[0]
+    mode = "reduce-overhead" if st_model.device.type == "cuda" else None
+    try:
+        transformer.auto_model = torch.compile(transformer.auto_model, dynamic=True, mode=mode)
+        with torch.inference_mode():
+            st_model.encode(ALLOWLIST_INTENTS[:2])
+    except Exception as e:
+        logger.warning(f"torch.compile failed for the food-domain encoder ({e}), running eagerly")
+        transformer.auto_model = getattr(transformer.auto_model, "_orig_mod", transformer.auto_model)
+
 def get_model():
     global _model
     if _model is None:
-        # Use a small model for CPU efficiency
-        _model = SentenceTransformer('all-MiniLM-L6-v2')
+        with _model_lock:
+            if _model is None:
+                # Imported here so Django/Celery start-up doesn't load torch + transformers
+                import torch
+                from sentence_transformers import SentenceTransformer
+
+                # Same per-process thread cap as CLIP; torch's pool is shared by both models
+                torch.set_num_threads(settings.GUARDRAILS_CLIP_THREADS)
+                try:
+                    torch.set_num_interop_threads(1)
+                except RuntimeError:
+                    pass
+                # Use a small model for CPU efficiency
+                model = SentenceTransformer(MODEL_NAME)
+                _ensure_fast_tokenizer(model)
+                if settings.GUARDRAILS_TEXT_BACKEND == 'onnx':
+                    model = _OnnxSentenceEncoder(_load_onnx_encoder(model), model.tokenizer, model.max_seq_length)
+                elif settings.GUARDRAILS_TEXT_COMPILE:
+                    _compile_encoder(model)
+                _model = model
     return _model
 
-def check_food_domain(text: str, threshold: float = 0.55) -> GuardrailResult:
+def get_intent_embeddings():
+    global _intent_embs
+    if _intent_embs is None:
+        import torch
+        with torch.inference_mode():
+            _intent_embs = get_model().encode(
+                ALLOWLIST_INTENTS, convert_to_tensor=True, normalize_embeddings=True
+            )
+    return _intent_embs
+
+def preload_text_model():
+    """Load the encoder and embed ALLOWLIST_INTENTS ahead of the first Stage B check."""
+    get_model()
+    get_intent_embeddings()
+    logger.info("Food-domain text model preloaded")
+
+def _food_matches(text: str) -> list:
+    """Return (start, end, item) for every FOOD_ITEMS occurrence in text."""
+    return [
+        (end - len(item) + 1, end + 1, item)
+        for end, item in _food_automaton.iter(text)
+    ]
+
+def _score_version() -> str:
+    """Changes whenever the model, its runtime or the intents change, invalidating stored scores."""
+    global _score_version_tag
+    if _score_version_tag is None:
+        _score_version_tag = hashlib.sha1(
+            repr((MODEL_NAME, settings.GUARDRAILS_TEXT_BACKEND, ALLOWLIST_INTENTS)).encode()
+        ).hexdigest()[:16]
+    return _score_version_tag
+
+def _persistent_key(text: str) -> str:
+    return f"food_domain:{_score_version()}:{hashlib.sha1(text.encode()).hexdigest()}"
+
+def _remember_scores(new_scores: dict):
+    """Add scores to the in-process LRU, evicting the least recently used."""
+    with _score_cache_lock:
+        for text, score in new_scores.items():
+            _score_cache[text] = score
+            _score_cache.move_to_end(text)
+        while len(_score_cache) > _SCORE_CACHE_SIZE:
+            _score_cache.popitem(last=False)
+
+def _embedding_scores(texts: list) -> list:
     """
-    Strict food domain check - only allows prompts explicitly about food items/context.
-    Uses fast keyword matching first, then strict embedding check.
+    Max cosine similarity between each normalized (lowercased, stripped) text and
+    ALLOWLIST_INTENTS. Scores come from the in-process LRU, then the persistent "guardrails"
+    cache; the remaining misses are embedded in one batched encode. MiniLM is uncased, so
+    keying on normalized text doesn't change the score. Failures raise and are not cached.
     """
-    text_lower = text.lower().strip()
+    if settings.GUARDRAILS_FAKE_MODEL:
+        return [_FAKE_SCORES.get(text, 0.0) for text in texts]
+
+    scores = {}
+    with _score_cache_lock:
+        for text in texts:
+            if text in _score_cache:
+                _score_cache.move_to_end(text)
+                scores[text] = _score_cache[text]
+    misses = [text for text in dict.fromkeys(texts) if text not in scores]
+
+    if misses:
+        # Scores persisted by earlier runs or other worker processes
+        keys = {_persistent_key(text): text for text in misses}
+        try:
+            stored = caches['guardrails'].get_many(list(keys))
+        except OSError as e:
+            logger.warning(f"Could not read persisted food-domain scores: {e}")
+            stored = {}
+        for key, score in stored.items():
+            scores[keys[key]] = score
+        _remember_scores({keys[key]: score for key, score in stored.items()})
+        misses = [text for text in misses if text not in scores]
+
+    if misses:
+        import torch
+        model = get_model()
+        intent_embs = get_intent_embeddings()
+        with torch.inference_mode():
+            text_embs = model.encode(misses, convert_to_tensor=True, normalize_embeddings=True)
+            # Both sides are unit-normalized, so the dot product is the cosine similarity
+            miss_scores = (text_embs @ intent_embs.T).max(dim=1).values.tolist()
+        scores.update(zip(misses, miss_scores))
+        _remember_scores(dict(zip(misses, miss_scores)))
+        try:
+            caches['guardrails'].set_many(
+                {_persistent_key(text): score for text, score in zip(misses, miss_scores)}
+            )
+        except OSError as e:
+            logger.warning(f"Could not persist food-domain scores: {e}")
+
+    return [scores[text] for text in texts]
+
+def _embedding_score(text: str) -> float:
+    return _embedding_scores([text])[0]
+
+def _keyword_stages(text_lower: str) -> Optional[GuardrailResult]:
+    """Stages 0 and A on normalized text; None when the embedding check has to decide."""
+    # One scan for food items, shared by every stage below
+    food_matches = _food_matches(text_lower)
     
     # Stage 0: Quick non-food pattern check (fastest)
     # Check for "generate/create/make image of X" patterns
-    image_of_pattern = r'\b(generate|create|make|show|display).*image.*of\s+(.+?)(?:\s|$)'
-    match = re.search(image_of_pattern, text_lower)
+    match = _IMAGE_OF_RE.search(text_lower)
     if match:
         # Extract what comes after "image of"
         subject = match.group(2).strip()
-        # Check if subject is a food item
-        is_food_item = any(item in subject for item in FOOD_ITEMS)
+        # Check if subject is a food item (a food match lying inside the subject span)
+        subject_start, subject_end = match.span(2)
+        is_food_item = any(
+            start >= subject_start and end <= subject_end
+            for start, end, _ in food_matches
+        )
         # Check if subject looks like a person name (common name patterns)
-        looks_like_person = bool(re.search(r'\b(emma|watson|hitler|person|people|man|woman|celebrity|actor)\b', subject))
+        looks_like_person = bool(_PERSON_RE.search(subject))
         
         if looks_like_person and not is_food_item:
             logger.info(f"Non-food pattern detected: image of {subject}")
@@ -90,12 +362,12 @@ def check_food_domain(text: str, threshold: float = 0.55) -> GuardrailResult:
             )
     
     # Also check other non-food patterns
-    for pattern in NON_FOOD_PATTERNS:
-        if re.search(pattern, text_lower):
+    for pattern in _NON_FOOD_RES:
+        if pattern.search(text_lower):
             # Check if it also mentions food - if not, block immediately
-            has_food_item = any(item in text_lower for item in FOOD_ITEMS)
+            has_food_item = bool(food_matches)
             if not has_food_item:
-                logger.info(f"Non-food pattern detected: {pattern}")
+                logger.info(f"Non-food pattern detected: {pattern.pattern}")
                 return GuardrailResult(
                     status="BLOCK",
                     reasons=["Prompt does not contain food-related items or context"],
@@ -103,7 +375,8 @@ def check_food_domain(text: str, threshold: float = 0.55) -> GuardrailResult:
                 )
     
     # Stage A: Fast keyword check - must contain actual food items/context
-    keyword_matches = [item for item in FOOD_ITEMS if item in text_lower]
+    found_items = {item for _, _, item in food_matches}
+    keyword_matches = [item for item in FOOD_ITEMS if item in found_items]
     if keyword_matches:
         # Strong food item match - fast path, approve immediately
         logger.info(f"Fast path: Food items found: {keyword_matches[:3]}")
@@ -112,35 +385,76 @@ def check_food_domain(text: str, threshold: float = 0.55) -> GuardrailResult:
             scores={"domain_score": 0.95, "method": "keyword_match", "matched_keywords": keyword_matches[:5]}
         )
 
-    # Stage B: Strict embedding check (only if no keywords found)
-    # Higher threshold - only allow if strongly food-related
-    try:
-        model = get_model()
-        text_emb = model.encode(text, convert_to_tensor=True)
-        intent_embs = model.encode(ALLOWLIST_INTENTS, convert_to_tensor=True)
-        
-        # Compute cosine similarities
-        cosine_scores = util.cos_sim(text_emb, intent_embs)
-        max_score = float(cosine_scores.max())
-        
-        # Strict threshold - block if score is below 0.55
-        if max_score < threshold:
-            logger.info(f"Embedding check failed: score {max_score:.2f} < threshold {threshold}")
-            return GuardrailResult(
-                status="BLOCK",
-                reasons=[f"Prompt not related to food items or context (score: {max_score:.2f})"],
-                scores={"domain_score": max_score, "method": "embedding"}
-            )
-            
-        logger.info(f"Embedding check passed: score {max_score:.2f}")
+    return None
+
+def _embedding_result(max_score: float, threshold: float) -> GuardrailResult:
+    """Stage B decision for an embedding score."""
+    # Strict threshold - block if score is below 0.55
+    if max_score < threshold:
+        logger.info(f"Embedding check failed: score {max_score:.2f} < threshold {threshold}")
         return GuardrailResult(
-            status="PASS",
+            status="BLOCK",
+            reasons=[f"Prompt not related to food items or context (score: {max_score:.2f})"],
             scores={"domain_score": max_score, "method": "embedding"}
         )
+        
+    logger.info(f"Embedding check passed: score {max_score:.2f}")
+    return GuardrailResult(
+        status="PASS",
+        scores={"domain_score": max_score, "method": "embedding"}
+    )
+
+def _embedding_failure(e: Exception) -> GuardrailResult:
+    logger.error(f"Domain check failed: {str(e)}")
+    # If embedding check fails and no keywords matched, block to be safe
+    return GuardrailResult(
+        status="BLOCK",
+        reasons=[f"Domain check failed: {str(e)}"]
+    )
+
+def check_food_domain(text: str, threshold: float = 0.55, text_lower: str = None) -> GuardrailResult:
+    """
+    Strict food domain check - only allows prompts explicitly about food items/context.
+    Uses fast keyword matching first, then strict embedding check.
+    Pass text_lower if the caller already lowercased text.
+    """
+    text_lower = (text.lower() if text_lower is None else text_lower).strip()
+    
+    result = _keyword_stages(text_lower)
+    if result is not None:
+        return result
+
+    # Stage B: Strict embedding check (only if no keywords found)
+    # Higher threshold - only allow if strongly food-related
+    try:
+        max_score = _embedding_score(text_lower)
     except Exception as e:
-        logger.error(f"Domain check failed: {str(e)}")
-        # If embedding check fails and no keywords matched, block to be safe
-        return GuardrailResult(
-            status="BLOCK",
-            reasons=[f"Domain check failed: {str(e)}"]
-        )
+        return _embedding_failure(e)
+    return _embedding_result(max_score, threshold)
+
+def check_food_domain_batch(texts: list, threshold: float = 0.55) -> list:
+    """
+    check_food_domain for several prompts. Keyword stages run per prompt; every prompt that
+    reaches Stage B is embedded in one batched encode. Returns one result per input, in order.
+    """
+    results = [None] * len(texts)
+    pending = {}  # normalized text -> indices needing the embedding check
+    for i, text in enumerate(texts):
+        text_lower = text.lower().strip()
+        results[i] = _keyword_stages(text_lower)
+        if results[i] is None:
+            pending.setdefault(text_lower, []).append(i)
+
+    if pending:
+        try:
+            scores = _embedding_scores(list(pending))
+        except Exception as e:
+            failure = _embedding_failure(e)
+            for indices in pending.values():
+                for i in indices:
+                    results[i] = GuardrailResult(status=failure.status, reasons=list(failure.reasons))
+        else:
+            for indices, max_score in zip(pending.values(), scores):
+                for i in indices:
+                    results[i] = _embedding_result(max_score, threshold)
+    return results
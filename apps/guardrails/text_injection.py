@@ -1,4 +1,4 @@
-import re
+from .matcher import TermMatcher
 from .schemas import GuardrailResult
 
 INJECTION_PATTERNS = [
@@ -11,25 +11,28 @@ INJECTION_PATTERNS = [
     r"do anything now",
 ]
 
-def check_injection(text: str) -> GuardrailResult:
-    """Check for prompt injection attempts."""
-    text_lower = text.lower()
+# The patterns are literal phrases: one scan of the prompt checks all of them at once
+_injection_matcher = TermMatcher(INJECTION_PATTERNS)
+
+def check_injection(text: str, text_lower: str = None) -> GuardrailResult:
+    """Check for prompt injection attempts. Pass text_lower if the caller already lowercased text."""
+    if text_lower is None:
+        text_lower = text.lower()
     
-    for pattern in INJECTION_PATTERNS:
-        if re.search(pattern, text_lower):
-            return GuardrailResult(
-                status="BLOCK",
-                reasons=[f"Potential prompt injection detected: {pattern}"]
-            )
+    found = _injection_matcher.find(text_lower)
+    if found:
+        # Name the first listed pattern that matched
+        return GuardrailResult(
+            status="BLOCK",
+            reasons=[f"Potential prompt injection detected: {found[0]}"]
+        )
             
     # Heuristic: Check for high entropy or base64-like blobs (simplified)
     # If a word is very long and has mixed case/numbers, it might be suspicious
-    words = text.split()
-    for word in words:
-        if len(word) > 40 and not word.startswith("http"):
-             return GuardrailResult(
-                status="BLOCK",
-                reasons=["Suspicious long string detected"]
-            )
+    if any(len(word) > 40 and not word.startswith("http") for word in text.split()):
+        return GuardrailResult(
+            status="BLOCK",
+            reasons=["Suspicious long string detected"]
+        )
 
     return GuardrailResult(status="PASS")
@@ -1,3 +1,4 @@
+from .matcher import TermMatcher
 from .schemas import GuardrailResult
 
 DENYLIST_TERMS = [
@@ -8,14 +9,16 @@ DENYLIST_TERMS = [
     "child", "minor", "kid",
 ]
 
-def check_policy(text: str) -> GuardrailResult:
-    """Check against policy denylist."""
-    text_lower = text.lower()
+# Single-pass multi-term matcher over the denylist
+_policy_matcher = TermMatcher(DENYLIST_TERMS)
+
+def check_policy(text: str, text_lower: str = None) -> GuardrailResult:
+    """Check against policy denylist. Pass text_lower if the caller already lowercased text."""
+    if text_lower is None:
+        text_lower = text.lower()
     
-    found_terms = []
-    for term in DENYLIST_TERMS:
-        if term in text_lower:
-            found_terms.append(term)
+    # Report in denylist order so reasons stay stable
+    found_terms = _policy_matcher.find(text_lower)
             
     if found_terms:
         return GuardrailResult(
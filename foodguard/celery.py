@@ -1,7 +1,11 @@
 import os
 from celery import Celery
+from celery.signals import worker_init, worker_process_init
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'foodguard.settings')
+# Workers preload their models in worker_process_init below. The app's background preload
+# (PRELOAD_TEXT_MODEL) would instead load torch in the prefork parent before it forks.
+os.environ['PRELOAD_TEXT_MODEL'] = 'False'
 
 # Import settings to check eager mode
 import django
@@ -40,3 +44,19 @@ if CELERY_TASK_ALWAYS_EAGER:
 
 app.autodiscover_tasks()
 
+
+@worker_process_init.connect
+def preload_guardrail_models(**kwargs):
+    """Load CLIP and the food-domain encoder in each worker process before it starts taking tasks."""
+    from apps.guardrails.image_food_clip import preload_clip_model
+    from apps.guardrails.text_food_domain import preload_text_model
+    preload_clip_model()
+    preload_text_model()
+
+
+@worker_init.connect
+def preload_guardrail_models_in_process(**kwargs):
+    """Thread/solo pools don't fork child processes, so preload in the worker itself."""
+    if app.conf.worker_pool in ('threads', 'solo'):
+        preload_guardrail_models()
+
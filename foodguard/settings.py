@@ -107,6 +107,22 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
+CELERY_WORKER_POOL = os.getenv('CELERY_WORKER_POOL', 'prefork')
+# Prefork children preload the guardrail models in worker_process_init before reporting UP;
+# Celery kills a child that hasn't reported within this many seconds (default 4, far less than
+# loading CLIP, let alone compiling or exporting it), so the pool would respawn forever
+CELERY_WORKER_PROC_ALIVE_TIMEOUT = float(os.getenv('CELERY_WORKER_PROC_ALIVE_TIMEOUT', '300'))
+# CLIP tasks are long and CPU-bound: take one at a time so idle workers aren't starved
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+# Outcomes are written to the GenerationRequest row, so task results are never read
+CELERY_TASK_IGNORE_RESULT = True
+# Ack on receipt: a redelivered task would find its row already PROCESSING and its staged
+# upload deleted, so redelivery can't recover a crashed task anyway
+CELERY_TASK_ACKS_LATE = False
+# The limits cover the guardrails plus the Gemini image-generation call, which can take
+# well over a minute; the soft limit surfaces inside generate_content as a Gemini Error
+CELERY_TASK_SOFT_TIME_LIMIT = int(os.getenv('CELERY_TASK_SOFT_TIME_LIMIT', '170'))
+CELERY_TASK_TIME_LIMIT = int(os.getenv('CELERY_TASK_TIME_LIMIT', '180'))
 
 # Prevent connection retries when using eager mode
 if CELERY_TASK_ALWAYS_EAGER:
@@ -115,6 +131,9 @@ if CELERY_TASK_ALWAYS_EAGER:
 
 # Redis Cache - fallback to local memory cache if Redis not available
 # When using eager mode, we don't need Redis, so use memory cache
+# GUARDRAILS_SHARED_CACHE records whether the web process and the task see the same default
+# cache (eager tasks run in-process); uploads are only staged in it when they do.
+GUARDRAILS_SHARED_CACHE = True
 if CELERY_TASK_ALWAYS_EAGER:
     CACHES = {
         "default": {
@@ -139,6 +158,7 @@ else:
         }
     except (ImportError, Exception):
         # Fallback to local memory cache if Redis is not available
+        GUARDRAILS_SHARED_CACHE = False
         CACHES = {
             "default": {
                 "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
@@ -146,10 +166,59 @@ else:
             }
         }
 
+# Persistent store for model-derived scores: shared by all processes on the host and kept
+# across restarts (keys carry a model/label version, so nothing needs expiring)
+CACHES["guardrails"] = {
+    "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+    "LOCATION": BASE_DIR / '.cache' / 'guardrails',
+    "TIMEOUT": None,
+    # FileBasedCache lists the whole directory on every set to enforce this cap. Sets only follow
+    # an encoder forward pass, which costs far more than listing this many files.
+    "OPTIONS": {"MAX_ENTRIES": 2000},
+}
+
 # Guardrails Config
 GUARDRAILS_MAX_PROMPT_CHARS = 800
 GUARDRAILS_MAX_IMAGE_BYTES = 5 * 1024 * 1024  # 5MB
 GUARDRAILS_MAX_PIXELS = 1536 * 1536
+# Seconds an uploaded image stays staged in the cache waiting for its Celery task
+GUARDRAILS_UPLOAD_TTL = 600
+# Seconds an earlier PASS for an identical prompt (+ image) is replayed instead of re-running
+# the guardrails; matches the guardrail decision-cache TTL so rule/model changes take effect
+GUARDRAILS_REPLAY_TTL = 3600
+# Torch intra-op threads per process for CLIP inference
+GUARDRAILS_CLIP_THREADS = int(os.getenv('CLIP_THREADS', '2'))
+# CLIP vision tower precision: "fp32", "int8" (dynamic quantization, faster on AVX512-VNNI CPUs)
+# or "bf16" (AVX512-BF16/AMX CPUs; falls back to fp32 elsewhere)
+GUARDRAILS_CLIP_PRECISION = os.getenv('CLIP_PRECISION', 'fp32')
+# CLIP vision tower runtime: "torch" or "onnx" (exported once to GUARDRAILS_CLIP_ONNX_PATH)
+GUARDRAILS_CLIP_BACKEND = os.getenv('CLIP_BACKEND', 'torch')
+# torch.compile the vision tower at load time (torch backend only; adds start-up time)
+GUARDRAILS_CLIP_COMPILE = os.getenv('CLIP_COMPILE', 'False') == 'True'
+GUARDRAILS_MODELS_DIR = BASE_DIR / 'models'
+# Derived artifacts (e.g. CLIP label text features) reused across worker restarts
+GUARDRAILS_CACHE_DIR = BASE_DIR / '.cache'
+GUARDRAILS_CLIP_ONNX_PATH = GUARDRAILS_MODELS_DIR / 'clip_vitb32_visual.onnx'
+# With CLIP_BACKEND=onnx and CLIP_PRECISION=int8 the ONNX model is quantized once; a directory of
+# sample food images enables static (calibrated) quantization instead of dynamic
+GUARDRAILS_CLIP_CALIBRATION_DIR = os.getenv('CLIP_CALIBRATION_DIR')
+# Micro-batching of concurrent CLIP requests within a worker (0 disables).
+# Needs several tasks in flight per process, i.e. CELERY_WORKER_POOL=threads.
+GUARDRAILS_CLIP_BATCH_WINDOW_MS = int(os.getenv('CLIP_BATCH_WINDOW_MS', '0'))
+GUARDRAILS_CLIP_MAX_BATCH = int(os.getenv('CLIP_MAX_BATCH', '8'))
+# Food-domain sentence encoder runtime: "torch" (SentenceTransformer) or "onnx"
+# (MiniLM exported once to GUARDRAILS_TEXT_ONNX_PATH and INT8-quantized for ONNX Runtime)
+GUARDRAILS_TEXT_BACKEND = os.getenv('TEXT_BACKEND', 'torch')
+GUARDRAILS_TEXT_ONNX_PATH = GUARDRAILS_MODELS_DIR / 'minilm_l6.onnx'
+# torch.compile the MiniLM encoder at load time (torch backend only; adds start-up time)
+GUARDRAILS_TEXT_COMPILE = os.getenv('TEXT_COMPILE', 'False') == 'True'
+# Load the food-domain encoder in a background thread when Django starts. Meant for processes
+# that run the guardrails in-line (CELERY_TASK_ALWAYS_EAGER); ignored by Celery workers, which
+# preload in worker_process_init (foodguard/celery.py turns it off).
+GUARDRAILS_PRELOAD_TEXT_MODEL = os.getenv('PRELOAD_TEXT_MODEL', 'False') == 'True'
+
+# Score Stage B from a fixed lookup table instead of loading MiniLM. For unit tests only.
+GUARDRAILS_FAKE_MODEL = os.getenv('GUARDRAILS_FAKE_MODEL', 'False') == 'True'
 
 # Gemini Config
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
@@ -0,0 +1,16 @@
+#!/bin/bash
+# Export the ONNX Runtime models into models/ ahead of deployment, so the first worker
+# doesn't pay for the export/quantization. Pass CLIP_PRECISION=int8 to also build the
+# INT8 CLIP vision encoder (and CLIP_CALIBRATION_DIR for static quantization).
+source venv/bin/activate
+TEXT_BACKEND=onnx CLIP_BACKEND=onnx python3 manage.py shell -c "
+from apps.guardrails import image_food_clip, text_food_domain
+
+print('Exporting MiniLM encoder (INT8)...')
+text_food_domain.get_model()
+
+print('Exporting CLIP vision encoder...')
+image_food_clip.get_clip_model()
+
+print('ONNX models exported to models/')
+"
@@ -0,0 +1,22 @@
+import importlib.util
+from unittest import skipUnless
+import numpy as np
+from PIL import Image
+from django.test import TestCase
+from apps.guardrails import image_food_clip
+
+
+@skipUnless(importlib.util.find_spec("open_clip"), "open_clip not installed")
+class ClipPreprocessTests(TestCase):
+    def test_preprocess_matches_open_clip(self):
+        # The numpy resize/crop/normalize must stay equivalent to open_clip's preprocess
+        import open_clip
+        preprocess = open_clip.image_transform(image_food_clip.CLIP_IMAGE_SIZE, is_train=False)
+        rng = np.random.default_rng(0)
+        for size in [(640, 480), (300, 900), (1001, 333), (224, 224)]:
+            pixels = rng.integers(0, 256, size=(size[1], size[0], 3), dtype=np.uint8)
+            img = Image.fromarray(pixels)
+            expected = preprocess(img).unsqueeze(0).numpy()
+            actual = image_food_clip._preprocess_np(img).numpy()
+            self.assertEqual(actual.shape, expected.shape)
+            np.testing.assert_allclose(actual, expected, atol=1e-4)